@@ -8,9 +8,38 @@ import urllib.parse
 import os
 import sys
 import base64
+import io
 import json
+import re
+import contextlib
+import functools
+import time
+# orjson 可选: 用于 Clash API 请求/响应的 JSON 编解码，未安装时回退到标准库
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+# ruamel.yaml 可选: 开启 preserve_yaml_format 时用往返模式写出，保留原文件的注释/引号/格式
+try:
+    from ruamel.yaml import YAML
+except ImportError:
+    YAML = None
+
 from utils.config_loader import load_config
+from utils.logger import get_logger, flush_logger
+from utils.profiler import enable_profiling, stage, timed
+from utils.yaml_utils import SafeLoader, SafeDumper
 from core.ip_checker import IPChecker
+from core.clash_pool import ClashPool
+
+log = get_logger()
 
 # --- CONFIGURATION ---
 cfg = load_config("config.yaml") or {}
@@ -20,10 +49,53 @@ CLASH_API_URL = cfg.get('clash_api_url', "http://127.0.0.1:9097")
 CLASH_API_SECRET = cfg.get('clash_api_secret', "")
 SELECTOR_NAME = cfg.get('selector_name', "GLOBAL")
 OUTPUT_SUFFIX = cfg.get('output_suffix', "_checked")
+PRESERVE_YAML_FORMAT = cfg.get('preserve_yaml_format', False)
+
+# 性能分析: 开启后各阶段及关键调用耗时以 JSON 行写入 profile.log
+if cfg.get('profile', False):
+    enable_profiling(cfg.get('profile_path', "profile.log"))
+
+# 并行配置: 额外启动的 Clash 实例，用于并行切换/检测节点 (需要 mihomo 可执行文件)
+CLASH_BINARY = cfg.get('clash_binary', "")
+PARALLEL_INSTANCES = cfg.get('parallel_instances', 1)
+
+# IP 纯净度缓存: 按 IP 持久化检测结果，跨节点、跨运行复用
+IP_CACHE_PATH = cfg.get('ip_cache_path', "ip_cache.json")
+IP_CACHE_TTL = cfg.get('ip_cache_ttl', 86400)  # 秒，过期后重新检测
+
+# 断点续检: Phase 2 每完成一个IP就追加写入结果，中断后下次运行跳过已完成的节点，正常结束后删除
+PARTIAL_RESULTS_PATH = cfg.get('partial_results_path', "results.partial.jsonl")
+
+# 节点名过滤: 含这些关键词的 (流量/到期等信息) 节点不参与测试，预编译为一个正则一次扫描
+# 配置须为列表且只取其中的非空字符串 (空串会匹配所有节点)，没有可用关键词时使用内置列表
+_skip_cfg = cfg.get('skip_keywords')
+SKIP_KEYWORDS = [k for k in _skip_cfg if isinstance(k, str) and k] if isinstance(_skip_cfg, list) else []
+SKIP_KEYWORDS = SKIP_KEYWORDS or ["剩余", "重置", "到期", "有效期", "官网", "网址", "更新", "公告"]
+SKIP_RE = re.compile("|".join(map(re.escape, SKIP_KEYWORDS)))
+
+# 统计分类: 结果字符串中的标记 -> stats 键 (按优先级排列)
+PURITY_MAP = {"⚪": "excellent", "🟢": "good", "🟡": "fair", "🟠": "medium", "🔴": "poor", "⚫": "bad"}
+IP_TYPE_MAP = {"住宅": "residential", "机房": "datacenter"}
+IP_SRC_MAP = {"原生": "native", "广播": "broadcast"}
+# 结果分类用的预编译正则: 一次扫描代替逐个子串查找
+PURITY_RE = re.compile("[" + "".join(PURITY_MAP) + "]")
+PURITY_RANK = {glyph: rank for rank, glyph in enumerate(PURITY_MAP)}  # 多个 emoji 同时出现时取等级最高者
+IP_TYPE_RE = re.compile("|".join(IP_TYPE_MAP))
+IP_SRC_RE = re.compile("|".join(IP_SRC_MAP))
+PREFIX_RE = re.compile(r'【([^】]+)】')  # 检测结果中的【…】前缀
 
 # 测速配置
-SPEED_TEST_URL = "http://www.gstatic.com/generate_204"
-SPEED_TEST_TIMEOUT = 5000 # 5000ms 超时,提高高延迟节点通过率
+SPEED_TEST_URL = cfg.get('speed_test_url', "http://www.gstatic.com/generate_204")
+SPEED_TEST_TIMEOUT = cfg.get('speed_test_timeout', 5000) # 5000ms 超时,提高高延迟节点通过率
+PHASE1_CONCURRENCY = cfg.get('phase1_concurrency', 100) # 同时测速的节点数 (即 API 连接池上限)，瓶颈在 Clash 自身而非网络
+
+@functools.lru_cache(maxsize=None)
+def quote_path(name):
+    """
+    节点/策略组名转义为 URL 路径段 (同一个名字在各阶段会被反复请求，结果缓存)
+    safe='' 使名字中的 '/' 也被转义，否则会被当成路径分隔符
+    """
+    return urllib.parse.quote(name, safe='')
 
 class ClashController:
     def __init__(self, api_url, secret=""):
@@ -32,50 +104,328 @@ class ClashController:
             "Authorization": f"Bearer {secret}",
             "Content-Type": "application/json"
         }
+        self.session = None
+        self._mixed_port = None
+
+    async def start(self):
+        # 整个运行期间共享一个 Session，复用到 Clash API 的 keep-alive 连接
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                json_serialize=json_dumps,
+                timeout=aiohttp.ClientTimeout(total=5),
+                # 连接数上限即并发上限: 超出的请求在 connector 内部排队，无需额外的 Semaphore
+                connector=aiohttp.TCPConnector(limit=PHASE1_CONCURRENCY, limit_per_host=PHASE1_CONCURRENCY, keepalive_timeout=60)
+            )
+        return self
+
+    async def stop(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
 
+    @timed("switch_proxy")
     async def switch_proxy(self, selector, proxy_name):
-        url = f"{self.api_url}/proxies/{urllib.parse.quote(selector)}"
+        url = f"{self.api_url}/proxies/{quote_path(selector)}"
         payload = {"name": proxy_name}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.put(url, json=payload, headers=self.headers, timeout=5) as resp:
-                    return resp.status == 204
+            async with self.session.put(url, json=payload) as resp:
+                return resp.status == 204
         except Exception as e:
             print(f"API Error switching to {proxy_name}: {e}")
             return False
 
+    async def wait_for_switch(self, selector, proxy_name, max_ms=2000):
+        """
+        轮询 selector 当前选中的节点，直到切换生效或超时
+        返回: 是否确认切换成功
+        """
+        url = f"{self.api_url}/proxies/{quote_path(selector)}"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_ms / 1000
+        interval = 0.05
+        while True:
+            try:
+                async with self.session.get(url) as resp:
+                    if resp.status == 200:
+                        data = json_loads(await resp.read())
+                        if data.get('now') == proxy_name:
+                            return True
+            except Exception:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, 0.4)
+
     async def set_mode(self, mode):
         url = f"{self.api_url}/configs"
         payload = {"mode": mode}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.patch(url, json=payload, headers=self.headers, timeout=5) as resp:
-                    return resp.status == 204
+            async with self.session.patch(url, json=payload) as resp:
+                return resp.status == 204
         except Exception:
             return False
 
+    async def get_mixed_port(self):
+        """
+        读取运行中 Clash 的 mixed-port (首次请求后缓存)
+        返回: 端口号，获取失败时返回默认 7890
+        """
+        if self._mixed_port is not None:
+            return self._mixed_port
+        mixed_port = 7890
+        try:
+            async with self.session.get(f"{self.api_url}/configs") as resp:
+                if resp.status == 200:
+                    conf = json_loads(await resp.read())
+                    if conf.get('mixed-port', 0) != 0: mixed_port = conf['mixed-port']
+        except Exception:
+            pass
+        self._mixed_port = mixed_port
+        return mixed_port
+
     async def get_proxy_delay(self, proxy_name):
         """
         调用 Clash API 测试单个节点延迟
         返回: 延迟(ms) 或 None (失败)
         """
-        encoded_name = urllib.parse.quote(proxy_name)
+        encoded_name = quote_path(proxy_name)
         url = f"{self.api_url}/proxies/{encoded_name}/delay"
         params = {
             "timeout": str(SPEED_TEST_TIMEOUT),
             "url": SPEED_TEST_URL
         }
+        # Clash 自身按 SPEED_TEST_TIMEOUT 超时返回，这里多留 1 秒余量
+        # 不设 total: 在 connector 中排队等待连接的时间不计入超时
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=SPEED_TEST_TIMEOUT / 1000 + 1)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=self.headers, params=params, timeout=5) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        return data.get('delay')
-                    else:
-                        return None
+            async with self.session.get(url, params=params, timeout=timeout) as resp:
+                if resp.status == 200:
+                    data = json_loads(await resp.read())
+                    return data.get('delay')
+                else:
+                    return None
         except Exception:
             return None
 
+def load_ip_cache(path):
+    """加载 IP 纯净度缓存，丢弃过期条目"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except Exception as e:
+        print(f"Error loading IP cache: {e}")
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    now = time.time()
+    fresh = {}
+    for ip, entry in cache.items():
+        # 旧格式或损坏的条目直接视为未命中
+        if not isinstance(entry, dict) or not isinstance(entry.get('full_string'), str):
+            continue
+        checked_at = entry.get('checked_at')
+        if isinstance(checked_at, (int, float)) and not isinstance(checked_at, bool) and now - checked_at < IP_CACHE_TTL:
+            fresh[ip] = entry
+    return fresh
+
+def endpoint_key(proxy):
+    """
+    节点的出口标识: 除名字/来源外的全部配置 (server、port、type 及 uuid/password、ws-opts、sni 等)
+    配置完全一致的节点才视为同一出口；没有 server 的节点返回 None，不与任何节点合并
+    """
+    if not proxy.get('server'):
+        return None
+    fields = {k: v for k, v in proxy.items() if k not in ('name', '_source')}
+    return json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+
+def partial_key(proxy):
+    """断点记录的键: 节点名 + server:port，订阅改名或换地址后旧记录不会被误用"""
+    return f"{proxy['name']}@{proxy.get('server')}:{proxy.get('port')}"
+
+def load_partial_results(path):
+    """读取上次中断时已成功完成的 Phase 2 结果 (每行一个 {partial_key: result})"""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 中断时写了一半的行
+                if isinstance(record, dict):
+                    results.update((k, v) for k, v in record.items() if isinstance(v, str))
+    except Exception as e:
+        print(f"Error loading partial results: {e}")
+    return results
+
+def save_ip_cache(path, cache):
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+    except Exception as e:
+        print(f"Error saving IP cache: {e}")
+
+def save_round_trip(source_path, output_path, removed_names, name_mapping):
+    """
+    用 ruamel.yaml 往返模式重新读取源文件，只删除/改名节点，
+    其余内容 (注释、引号、未改动的配置段) 原样写出
+    """
+    yaml_rt = YAML(typ='rt')
+    yaml_rt.preserve_quotes = True
+    yaml_rt.width = 4096
+    with open(source_path, 'r', encoding='utf-8') as f:
+        doc = yaml_rt.load(f)
+
+    proxies = doc.get('proxies') or []
+    for idx in reversed(range(len(proxies))):
+        name = proxies[idx].get('name')
+        if name in removed_names:
+            del proxies[idx]
+        elif name in name_mapping:
+            proxies[idx]['name'] = name_mapping[name]
+
+    for group in doc.get('proxy-groups') or []:
+        members = group.get('proxies')
+        if not members:
+            continue
+        for idx in reversed(range(len(members))):
+            if members[idx] in removed_names:
+                del members[idx]
+            elif members[idx] in name_mapping:
+                members[idx] = name_mapping[members[idx]]
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        yaml_rt.dump(doc, f)
+
+TOP_KEY_RE = re.compile(r'^([A-Za-z0-9_][\w.-]*)[ \t]*:(?=\s|$)', re.M)  # 顶层 (第0列) 的键
+
+OUTPUT_BUFFER_SIZE = 1 << 20  # 输出文件使用 1MB 写缓冲，dump 产生的大量小块写入合并后再落盘
+
+def dump_yaml(data, stream=None):
+    """统一的输出格式；超大 width 省去 PyYAML 的折行计算"""
+    return yaml.dump(data, stream, Dumper=SafeDumper, allow_unicode=True, default_flow_style=False, sort_keys=False, width=10**9)
+
+# JSON 原样保留、但 YAML 读取时不允许或会当作换行的字符，需改写为 \uXXXX 转义
+YAML_UNSAFE_RE = re.compile('[\x7f-\x9f\u2028\u2029\ud800-\udfff\ufffe\uffff]')
+
+def _escape_yaml_unsafe(match):
+    return "\\u%04x" % ord(match.group())
+
+def _is_json_native(obj):
+    """值是否只由 JSON 与 YAML 解析结果一致的类型构成 (浮点数在 YAML 1.1 下可能被当作字符串，排除)"""
+    if obj is None or isinstance(obj, (str, int)):  # bool 是 int 的子类
+        return True
+    if isinstance(obj, list):
+        return all(_is_json_native(v) for v in obj)
+    if isinstance(obj, dict):
+        return all(isinstance(k, str) and _is_json_native(v) for k, v in obj.items())
+    return False
+
+def dump_proxies_fast(proxies):
+    """
+    proxies 段的快速输出: 每个节点写成一行流式映射 (JSON 是合法的 YAML 流式写法)，
+    绕过 PyYAML 逐字段的事件/表示层；含其他类型的节点逐个回退到 dump_yaml
+    """
+    if not proxies:
+        return dump_yaml({'proxies': proxies})
+    lines = ["proxies:\n"]
+    for proxy in proxies:
+        if isinstance(proxy, dict) and _is_json_native(proxy):
+            text = YAML_UNSAFE_RE.sub(_escape_yaml_unsafe, json.dumps(proxy, ensure_ascii=False))
+            lines.append(f"- {text}\n")
+        else:
+            lines.append(dump_yaml([proxy]))
+    return ''.join(lines)
+
+def dump_section(key, value):
+    """按顶层键输出一段 YAML"""
+    if key == 'proxies' and isinstance(value, list):
+        return dump_proxies_fast(value)
+    return dump_yaml({key: value})
+
+def save_spliced(source_text, output_path, config_data, changed_keys=('proxies', 'proxy-groups')):
+    """
+    只重新序列化改动过的顶层段 (proxies / proxy-groups)，其余段直接拼接源文件原文
+    源文件无法按顶层键切分，或切出的原文与解析结果不一致时返回 False，由调用方整体 dump
+    """
+    matches = list(TOP_KEY_RE.finditer(source_text))
+    if [m.group(1) for m in matches] != list(config_data):
+        return False
+
+    parts = [source_text[:matches[0].start()] if matches else source_text]
+    for m, nxt in zip(matches, matches[1:] + [None]):
+        key = m.group(1)
+        if key in changed_keys:
+            parts.append(dump_section(key, config_data[key]))
+            continue
+        block = source_text[m.start():nxt.start() if nxt else len(source_text)]
+        # 锚点/别名跨段引用等情况下单独解析会失败或结果不同，此时放弃拼接
+        try:
+            if yaml.load(block, Loader=SafeLoader) != {key: config_data[key]}:
+                return False
+        except yaml.YAMLError:
+            return False
+        parts.append(block if block.endswith('\n') else block + '\n')
+
+    with open(output_path, 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE) as f:
+        f.write(''.join(parts))
+    return True
+
+async def poll_exit_ip(checker, proxy_url, accept, delays=(0.2, 0.4, 0.8)):
+    """
+    立即查询出口IP，结果不满足 accept 时按 delays 退避重查 (替代固定 sleep)
+    返回: 最后一次查到的IP (可能为 None)
+    """
+    ip = await checker.get_simple_ip(proxy_url)
+    for delay in delays:
+        if accept(ip):
+            break
+        await asyncio.sleep(delay)
+        ip = await checker.get_simple_ip(proxy_url)
+    return ip
+
+async def check_first_success(checker, proxy_url, attempts=2, timeout=10000):
+    """
+    同时发起多次纯净度检测，返回第一个成功的结果并取消其余检测
+    全部失败时返回最后完成的结果；全部抛异常时抛出第一个异常
+    """
+    tasks = [asyncio.create_task(checker.check(proxy=proxy_url, timeout=timeout)) for _ in range(attempts)]
+    fallback = None
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception():
+                    continue
+                res = task.result()
+                if res.get('error') is None and res.get('pure_score') != '❓':
+                    return res
+                fallback = res
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    if fallback is None:
+        return tasks[0].result()
+    return fallback
+
 async def process_proxies():
     print(f"Loading config from: {CLASH_CONFIG_PATH}", flush=True)
     if not os.path.exists(CLASH_CONFIG_PATH):
@@ -84,7 +434,8 @@ async def process_proxies():
 
     try:
         with open(CLASH_CONFIG_PATH, 'r', encoding='utf-8') as f:
-            config_data = yaml.full_load(f)
+            source_text = f.read()  # 保留原文，保存时未改动的段直接拼接
+        config_data = yaml.load(source_text, Loader=SafeLoader)
         print(f"Config loaded successfully", flush=True)
     except Exception as e:
         print(f"Error parsing YAML: {e}", flush=True)
@@ -97,121 +448,157 @@ async def process_proxies():
     
     print(f"Found {len(proxies)} proxies in config", flush=True)
 
-    SKIP_KEYWORDS = ["剩余", "重置", "到期", "有效期", "官网", "网址", "更新", "公告"]
-    
-    controller = ClashController(CLASH_API_URL, CLASH_API_SECRET)
+    async with contextlib.AsyncExitStack() as stack:
+        controller = await stack.enter_async_context(ClashController(CLASH_API_URL, CLASH_API_SECRET))
+        # mixed-port 与测速无关，和 Phase 1 并行获取，Phase 1.5 用到时再等待
+        mixed_port_task = asyncio.create_task(controller.get_mixed_port())
+        stack.callback(mixed_port_task.cancel)  # 提前退出时不留下未完成的任务
     
-    # --- 阶段 1: 快速连通性测试 (新增功能) ---
-    print(f"\n🚀 [Phase 1] Starting Connectivity Test for {len(proxies)} nodes...")
-    print(f"   Timeout: {SPEED_TEST_TIMEOUT}ms | URL: {SPEED_TEST_URL}")
+        # --- 阶段 1: 快速连通性测试 (新增功能) ---
+        print(f"\n🚀 [Phase 1] Starting Connectivity Test for {len(proxies)} nodes...")
+        print(f"   Timeout: {SPEED_TEST_TIMEOUT}ms | URL: {SPEED_TEST_URL} | Concurrency: {PHASE1_CONCURRENCY}")
     
-    valid_proxies = []
-    
-    # 限制并发数，防止把 Clash 冲垮
-    semaphore = asyncio.Semaphore(50) 
+        @timed("check_node")
+        async def check_node(i, proxy):
+            # 并发由 controller 的连接池上限 (PHASE1_CONCURRENCY) 控制，防止把 Clash 冲垮
+            delay = await controller.get_proxy_delay(proxy['name'])
+            return i, delay
 
-    async def check_node(proxy):
-        name = proxy['name']
-        # 关键词过滤
-        for kw in SKIP_KEYWORDS:
-            if kw in name:
-                return None
-        
-        async with semaphore:
-            delay = await controller.get_proxy_delay(name)
-            if delay:
-                print(f"   ✅ {delay}ms | {name}")
-                return proxy
-            else:
-                print(f"   ❌ Timeout | {name}")
-                return None
+        # 关键词过滤在创建任务之前完成，被过滤的节点不产生协程
+        candidates = [(i, p) for i, p in enumerate(proxies) if not SKIP_RE.search(p['name'])]
 
-    tasks = [check_node(p) for p in proxies]
-    results = await asyncio.gather(*tasks)
-    
-    # 过滤掉 None
-    valid_proxies = [p for p in results if p is not None]
+        # 按完成顺序实时输出，结果按原始顺序保留
+        async with stage("phase1", n=len(candidates)):
+            alive = set()
+            for fut in asyncio.as_completed([check_node(i, p) for i, p in candidates]):
+                i, delay = await fut
+                if delay:
+                    alive.add(i)
+                    log.info(f"   ✅ {delay}ms | {proxies[i]['name']}")
+                else:
+                    log.info(f"   ❌ Timeout | {proxies[i]['name']}")
+            flush_logger()
+
+        valid_proxies = [p for i, p in enumerate(proxies) if i in alive]
+        # 后续阶段频繁读取的名字/来源按列单独存放，按下标访问，节点 dict 只在最终改名时写回
+        names = [p['name'] for p in valid_proxies]
+        sources = [p.get('_source', 'Unknown') for p in valid_proxies]
     
-    print(f"\n📊 [Phase 1 Summary] Total: {len(proxies)} -> Alive: {len(valid_proxies)}")
-    print("---------------------------------------------------")
+        print(f"\n📊 [Phase 1 Summary] Total: {len(proxies)} -> Alive: {len(valid_proxies)}")
+        print("---------------------------------------------------")
 
-    if not valid_proxies:
-        print("No valid proxies left after speed test. Exiting.")
-        return
+        if not valid_proxies:
+            print("No valid proxies left after speed test. Exiting.")
+            return
 
-    # --- 阶段 1.5: IP 预检测去重 ---
-    print(f"\n🔄 [Phase 1.5] Pre-checking IPs for deduplication...")
+        # --- 阶段 1.5: IP 预检测去重 ---
+        print(f"\n🔄 [Phase 1.5] Pre-checking IPs for deduplication...")
     
-    # 强制全局模式
-    await controller.set_mode("global")
+        # 强制全局模式
+        await controller.set_mode("global")
     
-    # 获取端口
-    mixed_port = 7890
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{CLASH_API_URL}/configs", headers=controller.headers) as resp:
-                if resp.status == 200:
-                    conf = await resp.json()
-                    if conf.get('mixed-port', 0) != 0: mixed_port = conf['mixed-port']
-    except Exception:
-        pass
+        # 获取端口
+        mixed_port = await mixed_port_task
 
-    local_proxy_url = f"http://127.0.0.1:{mixed_port}"
-    print(f"Using Local Proxy: {local_proxy_url}")
+        local_proxy_url = f"http://127.0.0.1:{mixed_port}"
+        print(f"Using Local Proxy: {local_proxy_url}")
     
-    # 确定 Selector (通常是 GLOBAL)
-    selector_to_use = SELECTOR_NAME
-    # (省略了复杂的 selector 检测逻辑，直接尝试 GLOBAL，失败则尝试 Proxy)
-    # 简单的 fallback 逻辑
-    if not await controller.switch_proxy("GLOBAL", valid_proxies[0]['name']):
-        selector_to_use = "Proxy"
+        # 确定 Selector (通常是 GLOBAL)
+        selector_to_use = SELECTOR_NAME
+        # (省略了复杂的 selector 检测逻辑，直接尝试 GLOBAL，失败则尝试 Proxy)
+        # 简单的 fallback 逻辑
+        if not await controller.switch_proxy("GLOBAL", valid_proxies[0]['name']):
+            selector_to_use = "Proxy"
 
-    # IP去重逻辑
-    ip_to_proxy = {}  # IP -> 第一个使用该IP的proxy
-    unique_proxies = []
-    
-    # 新增：记录每个节点的IP状态（用于Phase 2优化）
-    node_ip_map = {}  # name -> ip (or None if failed)
-    
-    # 创建临时checker用于快速IP检测
-    temp_checker = IPChecker(headless=True)
-    await temp_checker.start()
+        # 并行 worker: (controller, selector, 本地代理地址)，第一个始终是当前运行的 Clash
+        workers = [(controller, selector_to_use, local_proxy_url)]
+        if PARALLEL_INSTANCES > 1 and CLASH_BINARY:
+            pool = ClashPool(CLASH_BINARY, valid_proxies, PARALLEL_INSTANCES - 1)
+            stack.push_async_callback(pool.stop)
+            for api_url, port in await pool.start():
+                extra_controller = await stack.enter_async_context(ClashController(api_url))
+                workers.append((extra_controller, "GLOBAL", f"http://127.0.0.1:{port}"))
+            print(f"Parallel Clash instances: {len(workers)}")
+
+        # IP去重逻辑
+        ip_to_idx = {}  # IP -> 第一个使用该IP的节点下标
+        unique_proxies = []
     
-    try:
-        # 串行逐个检测，给IP池充足的轮询时间
+        # 新增：记录每个节点的IP状态（用于Phase 2优化）
+        node_ip_map = {}  # name -> ip (or None if failed)
+
+        # 探测 worker (生产者) 把 (index, ip, 是否切换成功) 放入队列，
+        # 去重 (消费者) 按原始顺序边收边处理，保证 "先出现者保留" 与串行检测一致
+        probe_queue = asyncio.Queue()
+
+        # 除名字外配置完全相同的节点出口相同，只切换探测第一个，其余直接继承结果
+        endpoint_groups = {}  # endpoint -> 节点下标列表
         for i, proxy in enumerate(valid_proxies):
-            name = proxy['name']
-            source = proxy.get('_source', 'Unknown')
-            print(f"   [{i+1}/{len(valid_proxies)}] Checking: {name} ({source})")
-            
-            # 切换节点
-            if not await controller.switch_proxy(selector_to_use, name):
+            endpoint = endpoint_key(proxy)
+            endpoint_groups.setdefault(i if endpoint is None else endpoint, []).append(i)
+        if len(endpoint_groups) < len(valid_proxies):
+            print(f"   Same endpoint: {len(valid_proxies) - len(endpoint_groups)} nodes reuse a sibling's probe")
+
+        # 待检测节点放入共享队列，空闲的 worker 随取随测，慢节点不会拖住整个分片
+        pending_queue = asyncio.Queue()
+        for indices in endpoint_groups.values():
+            pending_queue.put_nowait(indices)
+    
+        # 每个 Clash 实例配一个 checker，Phase 1.5 (快速IP检测) 与 Phase 2 (浏览器检测) 共用，
+        # 两个阶段结束后统一关闭
+        checkers = [IPChecker(headless=True) for _ in workers]
+        stack.push_async_callback(lambda: asyncio.gather(*[c.stop() for c in checkers]))
+
+        async def probe_worker(worker, checker):
+            worker_controller, worker_selector, worker_proxy_url = worker
+            last_ip = None  # 本 worker 上一个节点的出口IP
+            while not pending_queue.empty():
+                indices = pending_queue.get_nowait()
+                name = names[indices[0]]
+
+                # 切换节点
+                if not await worker_controller.switch_proxy(worker_selector, name):
+                    for i in indices:
+                        probe_queue.put_nowait((i, None, False))
+                    continue
+
+                # 等待切换生效 (确认后立即继续，最多等待 1.5 秒)
+                await worker_controller.wait_for_switch(worker_selector, name, max_ms=1500)
+
+                # 快速获取IP
+                # 与上一个节点IP相同时可能仍走旧出口，短暂退避重查 (最多 0.6 秒)，一旦变化立即返回
+                ip = await poll_exit_ip(checker, worker_proxy_url, lambda got: got is None or got != last_ip,
+                                        delays=(0.2, 0.4))
+                last_ip = ip
+                for i in indices:
+                    probe_queue.put_nowait((i, ip, True))
+
+        def dedup(i, ip, switched):
+            proxy = valid_proxies[i]
+            name = names[i]
+            current_source = sources[i]
+            print(f"   [{i+1}/{len(valid_proxies)}] Checking: {name} ({current_source})")
+
+            if not switched:
                 print(f"      -> Switch failed, keeping node.")
                 unique_proxies.append(proxy)
-                continue
+                return
 
-            # 等待切换生效，给IP池时间轮询
-            await asyncio.sleep(1.5)
-            
-            # 快速获取IP
-            ip = await temp_checker.get_simple_ip(local_proxy_url)
-            
             # 记录IP映射（用于Phase 2优化）
             node_ip_map[name] = ip  # 可能是 None
-            
+
             if ip:
-                if ip not in ip_to_proxy:
+                first = ip_to_idx.get(ip)
+                if first is None:
                     # 第一次见到这个IP，保留
-                    ip_to_proxy[ip] = proxy
+                    ip_to_idx[ip] = i
                     unique_proxies.append(proxy)
                     print(f"      ✅ {ip} | {name}")
                 else:
                     # 重复IP，判断是否跨订阅
-                    duplicate_proxy = ip_to_proxy[ip]
-                    duplicate_name = duplicate_proxy['name']
-                    duplicate_source = duplicate_proxy.get('_source', 'Unknown')
-                    current_source = proxy.get('_source', 'Unknown')
-                    
+                    duplicate_name = names[first]
+                    duplicate_source = sources[first]
+
                     if duplicate_source == current_source:
                         # 同订阅内IP重复 = IP池共享，仍然保留
                         unique_proxies.append(proxy)
@@ -226,118 +613,194 @@ async def process_proxies():
                 # IP获取失败的也保留，后续浏览器检测
                 unique_proxies.append(proxy)
                 print(f"      ❓ Unknown IP | {name}")
-    finally:
-        await temp_checker.stop()
+
+        async def dedup_consumer():
+            arrived = {}  # 先于前序节点完成的结果暂存于此
+            next_i = 0
+            while next_i < len(valid_proxies):
+                i, ip, switched = await probe_queue.get()
+                arrived[i] = (ip, switched)
+                while next_i in arrived:
+                    dedup(next_i, *arrived.pop(next_i))
+                    next_i += 1
     
-    print(f"\n📊 [Phase 1.5 Summary] Unique IPs: {len(unique_proxies)} / {len(valid_proxies)}")
+        async with stage("phase1.5", n=len(valid_proxies), workers=len(workers)):
+            # 每个 worker 独占一个 Clash 实例，从共享队列取节点并行检测
+            await asyncio.gather(dedup_consumer(), *[probe_worker(w, c) for w, c in zip(workers, checkers)])
     
-    # --- 阶段 2: IP 纯净度检查 (优化版：三层优化策略) ---
-    print(f"\n🕵️ [Phase 2] Starting IP Purity Check (Optimized)...")
+        print(f"\n📊 [Phase 1.5 Summary] Unique IPs: {len(unique_proxies)} / {len(valid_proxies)}")
     
-    # 统计信息
-    stats_skipped = 0    # 跳过的节点（IP不可用）
-    stats_cached = 0     # 缓存继承的节点
-    stats_detected = 0   # 实际检测的节点
+        # --- 阶段 2: IP 纯净度检查 (优化版：三层优化策略) ---
+        print(f"\n🕵️ [Phase 2] Starting IP Purity Check (Optimized)...")
     
-    results_map = {}  # name -> result_suffix
-    ip_result_cache = {}  # IP -> result_string (缓存复用)
+        # 统计信息
+        stats_skipped = 0    # 跳过的节点（IP不可用）
+        stats_cached = 0     # 缓存继承的节点
+        stats_detected = 0   # 实际检测的节点
+        stats_ip_cache = 0   # 命中持久化IP缓存的IP数
+        stats_resumed = 0    # 从上次中断结果恢复的IP数
     
-    # 层次1 & 层次3：按IP分组，跳过失败节点
-    ip_groups = {}  # IP -> list of proxies
-    skipped_proxies = []  # IP获取失败的节点
+        results_map = {}  # name -> result_suffix
+        ip_result_cache = {}  # IP -> result_string (缓存复用)
+        ip_purity_cache = load_ip_cache(IP_CACHE_PATH)  # IP -> 上次检测结果 (持久化)
     
-    for proxy in unique_proxies:
-        name = proxy['name']
-        ip = node_ip_map.get(name)
-        if ip:
-            ip_groups.setdefault(ip, []).append(proxy)
-        else:
-            # 层次1：IP获取失败的节点直接标记为未知
-            results_map[name] = "【❓❓ 未知】"
-            skipped_proxies.append(name)
-            stats_skipped += 1
-    
-    print(f"   📊 预处理统计:")
-    print(f"      - 跳过 (IP不可用): {stats_skipped} 节点")
-    print(f"      - 待检测唯一IP数: {len(ip_groups)} 个")
-    print(f"      - 涉及节点总数: {len(unique_proxies) - stats_skipped} 个")
-    
-    if skipped_proxies:
-        print(f"\n   ⏭️ 跳过的节点 (Phase 1.5 IP获取失败):")
-        for name in skipped_proxies[:5]:  # 只显示前5个
-            print(f"      - {name}")
-        if len(skipped_proxies) > 5:
-            print(f"      ... 及其他 {len(skipped_proxies) - 5} 个节点")
-    
-    checker = IPChecker(headless=True)
-    await checker.start()
+        # 层次1 & 层次3：按IP分组，跳过失败节点
+        ip_groups = {}  # IP -> list of proxies
+        skipped_proxies = []  # IP获取失败的节点
+    
+        for proxy in unique_proxies:
+            name = proxy['name']
+            ip = node_ip_map.get(name)
+            if ip:
+                ip_groups.setdefault(ip, []).append(proxy)
+            else:
+                # 层次1：IP获取失败的节点直接标记为未知
+                results_map[name] = "【❓❓ 未知】"
+                skipped_proxies.append(name)
+                stats_skipped += 1
+    
+        print(f"   📊 预处理统计:")
+        print(f"      - 跳过 (IP不可用): {stats_skipped} 节点")
+        print(f"      - 待检测唯一IP数: {len(ip_groups)} 个")
+        print(f"      - 涉及节点总数: {len(unique_proxies) - stats_skipped} 个")
+    
+        if skipped_proxies:
+            print(f"\n   ⏭️ 跳过的节点 (Phase 1.5 IP获取失败):")
+            for name in skipped_proxies[:5]:  # 只显示前5个
+                print(f"      - {name}")
+            if len(skipped_proxies) > 5:
+                print(f"      ... 及其他 {len(skipped_proxies) - 5} 个节点")
+    
+        # 上次中断前已完成的IP直接复用结果
+        partial_results = load_partial_results(PARTIAL_RESULTS_PATH)
+        for ip in list(ip_groups):
+            done_key = next((k for k in map(partial_key, ip_groups[ip]) if k in partial_results), None)
+            if done_key is None:
+                continue
+            group = ip_groups.pop(ip)
+            ip_result_cache[ip] = partial_results[done_key]
+            for proxy in group:
+                results_map[proxy['name']] = partial_results[done_key]
+            stats_resumed += 1
+            stats_cached += len(group)
+        if stats_resumed:
+            print(f"   ♻️ 断点续检: 复用 {stats_resumed} 个IP的结果 ({PARTIAL_RESULTS_PATH})")
+
+        # 命中持久化缓存的IP直接复用结果，无需切换和浏览器检测
+        for ip in list(ip_groups):
+            cached = ip_purity_cache.get(ip)
+            if not cached:
+                continue
+            group = ip_groups.pop(ip)
+            ip_result_cache[ip] = cached['full_string']
+            for proxy in group:
+                results_map[proxy['name']] = cached['full_string']
+            stats_ip_cache += 1
+            stats_cached += len(group)
+        if stats_ip_cache:
+            print(f"   💾 IP缓存命中: {stats_ip_cache} 个IP ({IP_CACHE_PATH})")
 
-    try:
         # 层次3：每个IP只检测一个代表节点
         ip_list = list(ip_groups.keys())
-        for i, ip in enumerate(ip_list):
-            group = ip_groups[ip]
-            representative = group[0]  # 取第一个作为代表
-            representative_name = representative['name']
-            
-            print(f"\n[{i+1}/{len(ip_list)}] 检测IP: {ip}")
-            print(f"   代表节点: {representative_name}")
-            if len(group) > 1:
-                print(f"   同IP节点: {len(group)} 个 (将继承结果)")
-            
-            # 切换到代表节点
-            if not await controller.switch_proxy(selector_to_use, representative_name):
-                print("   ❌ 代理切换失败，标记为未知")
-                result = "【❓❓ 未知】"
-            else:
-                await asyncio.sleep(1)  # 层次2：从2秒优化到1秒
-                
-                # 检测IP纯净度
-                res = None
-                try:
-                    res = await checker.check(proxy=local_proxy_url, timeout=10000)  # 层次2：超时优化
-                    if res.get('error') is None and res.get('pure_score') != '❓':
-                        result = res.get('full_string', "【❓❓ 未知】")
-                    else:
-                        result = res.get('full_string', "【❓❓ 未知】")
-                except Exception as e:
-                    print(f"   ⚠️ 检测异常: {e}")
+
+        # 浏览器只在确有IP需要检测时启动 (全部命中缓存时完全不启动)
+        if ip_list:
+            await asyncio.gather(*[c.start() for c in checkers])
+        ip_queue = asyncio.Queue()
+        for item in enumerate(ip_list):
+            ip_queue.put_nowait(item)
+
+        async def purity_worker(worker, checker):
+            nonlocal stats_detected, stats_cached
+            worker_controller, worker_selector, worker_proxy_url = worker
+            while not ip_queue.empty():
+                i, ip = ip_queue.get_nowait()
+                group = ip_groups[ip]
+                representative = group[0]  # 取第一个作为代表
+                representative_name = representative['name']
+
+                # 每个IP的输出先缓冲，完成后整体打印，避免并行时交错
+                lines = [f"\n[{i+1}/{len(ip_list)}] 检测IP: {ip}", f"   代表节点: {representative_name}"]
+                if len(group) > 1:
+                    lines.append(f"   同IP节点: {len(group)} 个 (将继承结果)")
+
+                succeeded = False
+                # 切换到代表节点
+                if not await worker_controller.switch_proxy(worker_selector, representative_name):
+                    lines.append("   ❌ 代理切换失败，标记为未知")
                     result = "【❓❓ 未知】"
-                
-                stats_detected += 1
-            
-            # 缓存结果
-            ip_result_cache[ip] = result
-            
-            # 传播结果到所有同IP节点
-            for proxy in group:
-                name = proxy['name']
-                results_map[name] = result
-                if name != representative_name:
-                    stats_cached += 1
-            
-            # 显示结果
-            print(f"   ✅ 结果: {result}")
-            if len(group) > 1:
-                inherited_names = [p['name'] for p in group[1:]]
-                for inherited_name in inherited_names[:3]:
-                    print(f"      ↳ 缓存继承: {inherited_name}")
-                if len(inherited_names) > 3:
-                    print(f"      ↳ ... 及其他 {len(inherited_names) - 3} 个节点")
-
-    except KeyboardInterrupt:
-        print("\nInterrupted. Saving...")
-    finally:
-        await checker.stop()
+                else:
+                    await worker_controller.wait_for_switch(worker_selector, representative_name, max_ms=1000)  # 层次2：确认切换即开始检测
+                    # 先用轻量接口确认出口已是该组IP，再启动浏览器检测
+                    await poll_exit_ip(checker, worker_proxy_url, lambda got: got == ip)
+
+                    # 检测IP纯净度
+                    res = None
+                    try:
+                        res = await check_first_success(checker, worker_proxy_url, timeout=10000)  # 层次2：超时优化 + 并发双发
+                        if res.get('error') is None and res.get('pure_score') != '❓':
+                            result = res.get('full_string', "【❓❓ 未知】")
+                            succeeded = True
+                            ip_purity_cache[ip] = {
+                                "full_string": result,
+                                "pure_score": res.get('pure_score'),
+                                "checked_at": time.time()
+                            }
+                        else:
+                            result = res.get('full_string', "【❓❓ 未知】")
+                    except Exception as e:
+                        lines.append(f"   ⚠️ 检测异常: {e}")
+                        result = "【❓❓ 未知】"
+
+                    stats_detected += 1
+
+                # 缓存结果
+                ip_result_cache[ip] = result
+
+                # 传播结果到所有同IP节点
+                for proxy in group:
+                    name = proxy['name']
+                    results_map[name] = result
+                    if name != representative_name:
+                        stats_cached += 1
+
+                # 成功的结果立即追加到断点文件 (不 fsync)，崩溃后可从这里恢复；失败/未知的下次重新检测
+                if succeeded:
+                    partial_file.write(json.dumps({partial_key(p): result for p in group}, ensure_ascii=False) + "\n")
+                    partial_file.flush()
+
+                # 显示结果
+                lines.append(f"   ✅ 结果: {result}")
+                if len(group) > 1:
+                    inherited_names = [p['name'] for p in group[1:]]
+                    for inherited_name in inherited_names[:3]:
+                        lines.append(f"      ↳ 缓存继承: {inherited_name}")
+                    if len(inherited_names) > 3:
+                        lines.append(f"      ↳ ... 及其他 {len(inherited_names) - 3} 个节点")
+                print("\n".join(lines))
+
+        async with stage("phase2", n=len(ip_list), workers=len(workers)):
+            partial_file = open(PARTIAL_RESULTS_PATH, 'a', encoding='utf-8')
+            try:
+                await asyncio.gather(*[purity_worker(w, c) for w, c in zip(workers, checkers)])
+            except KeyboardInterrupt:
+                print("\nInterrupted. Saving...")
+            finally:
+                partial_file.close()
+                save_ip_cache(IP_CACHE_PATH, ip_purity_cache)
     
-    # 输出Phase 2统计
-    print(f"\n📊 [Phase 2 Summary - 优化效果]")
-    print(f"   ⏭️ 跳过 (IP不可用): {stats_skipped} 节点")
-    print(f"   🔍 实际检测: {stats_detected} 个唯一IP")
-    print(f"   💾 缓存继承: {stats_cached} 节点")
-    print(f"   📈 检测效率: 检测 {stats_detected} 次覆盖 {len(unique_proxies)} 节点")
-    if stats_detected > 0:
-        print(f"   ⚡ 优化比例: {(stats_skipped + stats_cached) / len(unique_proxies) * 100:.1f}% 节点无需检测")
+        # 输出Phase 2统计
+        print(f"\n📊 [Phase 2 Summary - 优化效果]")
+        print(f"   ⏭️ 跳过 (IP不可用): {stats_skipped} 节点")
+        print(f"   🔍 实际检测: {stats_detected} 个唯一IP")
+        print(f"   💾 缓存继承: {stats_cached} 节点")
+        if stats_ip_cache:
+            print(f"   🗂️ IP缓存命中: {stats_ip_cache} 个IP")
+        if stats_resumed:
+            print(f"   ♻️ 断点续检: {stats_resumed} 个IP")
+        print(f"   📈 检测效率: 检测 {stats_detected} 次覆盖 {len(unique_proxies)} 节点")
+        if stats_detected > 0:
+            print(f"   ⚡ 优化比例: {(stats_skipped + stats_cached) / len(unique_proxies) * 100:.1f}% 节点无需检测")
 
     # --- 阶段 3: 统计与保存 ---
     print("\n📊 [Phase 3] Generating Statistics...")
@@ -357,23 +820,50 @@ async def process_proxies():
         "broadcast": 0    # 广播IP
     }
 
-    for name, result_str in results_map.items():
+    # 未通过测速 (或被关键词过滤) 的原始节点名，需要从 proxy-groups 中移除
+    # 注意要在改名之前计算
+    removed_names = {p['name'] for p in proxies}.difference(names)
+
+    # 统计与改名合并为一次遍历: 我们只保存 Phase 1 存活下来的节点，并更新名字
+    final_proxies = []
+    name_mapping = {}
+
+    for proxy, old_name in zip(valid_proxies, names):  # 注意：这里还是用valid_proxies，因为要去重所有节点
+        result_str = results_map.get(old_name)
+        if result_str is None:
+            # 测速通过了，但 IP 检测没结果（可能中断了），也保留
+            final_proxies.append(proxy)
+            continue
+
         # 统计纯净度
-        if "⚪" in result_str: stats["excellent"] += 1
-        elif "🟢" in result_str: stats["good"] += 1
-        elif "🟡" in result_str: stats["fair"] += 1
-        elif "🟠" in result_str: stats["medium"] += 1
-        elif "🔴" in result_str: stats["poor"] += 1
-        elif "⚫" in result_str: stats["bad"] += 1
-        else: stats["unknown"] += 1
-        
+        glyphs = PURITY_RE.findall(result_str)
+        if glyphs:
+            stats[PURITY_MAP[min(glyphs, key=PURITY_RANK.get)]] += 1
+        else:
+            stats["unknown"] += 1
+
         # 统计IP类型
-        if "住宅" in result_str: stats["residential"] += 1
-        elif "机房" in result_str: stats["datacenter"] += 1
-        
+        m = IP_TYPE_RE.search(result_str)
+        if m:
+            stats[IP_TYPE_MAP[m.group()]] += 1
+
         # 统计IP来源
-        if "原生" in result_str: stats["native"] += 1
-        elif "广播" in result_str: stats["broadcast"] += 1
+        m = IP_SRC_RE.search(result_str)
+        if m:
+            stats[IP_SRC_MAP[m.group()]] += 1
+
+        # 方案C格式：【🟢🟠 机|广】原节点名
+        # 直接提取【】内的完整内容作为前缀
+        emoji_match = PREFIX_RE.search(result_str)
+        if emoji_match:
+            new_name = f"{emoji_match.group()}{old_name}"
+        else:
+            # 没有匹配到，使用原格式
+            new_name = f"{old_name} {result_str}"
+
+        proxy['name'] = new_name
+        name_mapping[old_name] = new_name
+        final_proxies.append(proxy)
 
     # 输出统计报告到控制台
     print(f"""
@@ -392,47 +882,20 @@ async def process_proxies():
 """)
 
     print("\n💾 Saving results...")
-    
-    # 我们只保存 Phase 1 存活下来的节点，并更新名字
-    final_proxies = []
-    name_mapping = {}
 
-    for proxy in valid_proxies:  # 注意：这里还是用valid_proxies，因为要去重所有节点
-        old_name = proxy['name']
-        if old_name in results_map:
-            # 方案C格式：【🟢🟠 机|广】原节点名
-            result_suffix = results_map[old_name]
-            
-            # 直接提取【】内的完整内容作为前缀
-            import re
-            emoji_match = re.search(r'【([^】]+)】', result_suffix)
-            if emoji_match:
-                prefix = f"【{emoji_match.group(1)}】"
-                new_name = f"{prefix}{old_name}"
-            else:
-                # 没有匹配到，使用原格式
-                new_name = f"{old_name} {result_suffix}"
-            
-            proxy['name'] = new_name
-            name_mapping[old_name] = new_name
-            final_proxies.append(proxy)
-        else:
-            # 测速通过了，但 IP 检测没结果（可能中断了），也保留
-            final_proxies.append(proxy)
-    
     config_data['proxies'] = final_proxies
 
     # 更新 Proxy Groups (如果有的话)
     if 'proxy-groups' in config_data:
+        # 绑定方法提到循环外，组数 × 成员数的内层循环里省去属性查找
+        mapping_get = name_mapping.get
+        is_removed = removed_names.__contains__
         for group in config_data['proxy-groups']:
-            if 'proxies' in group:
-                new_group_proxies = []
-                for p_name in group['proxies']:
-                    # 如果原节点被改名了，用新名字
-                    if p_name in name_mapping:
-                        new_group_proxies.append(name_mapping[p_name])
-                    # 如果原节点没改名（说明没通过测速被删了），就不加进去
-                group['proxies'] = new_group_proxies
+            members = group.get('proxies')
+            if members:
+                # 改名的节点用新名字；被删除的节点移除；
+                # DIRECT / REJECT / 其他策略组引用以及未改名的存活节点原样保留
+                group['proxies'] = [mapping_get(p_name, p_name) for p_name in members if not is_removed(p_name)]
 
     # 保存
     base = os.path.basename(CLASH_CONFIG_PATH)
@@ -440,41 +903,56 @@ async def process_proxies():
     output_filename = f"{filename}{OUTPUT_SUFFIX}{ext}"
     output_path = os.path.join(os.getcwd(), output_filename)
     
-    try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            yaml.dump(config_data, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
-        print(f"\n✅ Clash格式已保存: {output_path}")
-    except Exception as e:
-        print(f"Error saving Clash config: {e}")
+    if PRESERVE_YAML_FORMAT and YAML is None:
+        print("⚠️ preserve_yaml_format 需要 ruamel.yaml (pip install ruamel.yaml)，改用普通格式保存")
+
+    async with stage("save_yaml", n=len(final_proxies)):
+        try:
+            if PRESERVE_YAML_FORMAT and YAML is not None:
+                save_round_trip(CLASH_CONFIG_PATH, output_path, removed_names, name_mapping)
+            elif not save_spliced(source_text, output_path, config_data):
+                with open(output_path, 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE) as f:
+                    f.write(''.join(dump_section(key, value) for key, value in config_data.items()))
+            print(f"\n✅ Clash格式已保存: {output_path}")
+        except Exception as e:
+            print(f"Error saving Clash config: {e}")
+        else:
+            # 结果已完整写出，断点文件不再需要
+            if os.path.exists(PARTIAL_RESULTS_PATH):
+                os.remove(PARTIAL_RESULTS_PATH)
     
     # --- 新增：生成v2rayN格式订阅 ---
     print("\n📝 Generating v2rayN subscription...")
-    v2rayn_links = []
+    # 链接直接以 UTF-8 写入缓冲区 (换行分隔)，省去 join 后的整串拷贝
+    v2rayn_buf = io.BytesIO()
+    link_count = 0
     
     for proxy in final_proxies:
         try:
             link = convert_to_v2rayn_link(proxy)
             if link:
-                v2rayn_links.append(link)
+                if link_count:
+                    v2rayn_buf.write(b'\n')
+                v2rayn_buf.write(link.encode('utf-8'))
+                link_count += 1
         except Exception as e:
             print(f"  ⚠️ Failed to convert {proxy['name']}: {e}")
     
     v2rayn_count = 0
-    if v2rayn_links:
-        # Base64编码
-        v2rayn_content = '\n'.join(v2rayn_links)
-        v2rayn_base64 = base64.b64encode(v2rayn_content.encode('utf-8')).decode('utf-8')
+    if link_count:
+        # Base64编码 (直接编码缓冲区内容，不再复制一份 bytes)
+        v2rayn_base64 = base64.b64encode(v2rayn_buf.getbuffer())
         
         # 保存v2rayN订阅文件
         v2rayn_filename = f"{filename}{OUTPUT_SUFFIX}_v2rayn.txt"
         v2rayn_path = os.path.join(os.getcwd(), v2rayn_filename)
         
         try:
-            with open(v2rayn_path, 'w', encoding='utf-8') as f:
+            with open(v2rayn_path, 'wb') as f:
                 f.write(v2rayn_base64)
             print(f"✅ v2rayN格式已保存: {v2rayn_path}")
-            print(f"   节点数量: {len(v2rayn_links)}")
-            v2rayn_count = len(v2rayn_links)
+            print(f"   节点数量: {link_count}")
+            v2rayn_count = link_count
         except Exception as e:
             print(f"Error saving v2rayN subscription: {e}")
     else:
@@ -573,8 +1051,18 @@ def convert_to_v2rayn_link(proxy):
         print(f"  ⚠️ Unsupported protocol: {proxy_type} for {name}")
         return None
 
+def quote_name(name):
+    """链接末尾 #备注 的转义，与 urllib.parse.quote 默认行为一致 (保留 '/')"""
+    return urllib.parse.quote_from_bytes(name.encode('utf-8'), safe='/')
+
+# 复用同一个紧凑格式的 encoder (json.dumps 带参数时每次调用都会新建一个)
+_vmess_json = json.JSONEncoder(separators=(',', ':')).encode
+
 def convert_vmess(proxy):
     """转换VMess节点"""
+    is_ws = proxy.get('network') == 'ws'
+    ws_opts = proxy.get('ws-opts', {}) if is_ws else {}
+    ws_path = ws_opts.get('path', '')
     vmess_config = {
         "v": "2",
         "ps": proxy.get('name', ''),
@@ -583,16 +1071,16 @@ def convert_vmess(proxy):
         "id": proxy.get('uuid', ''),
         "aid": str(proxy.get('alterId', 0)),
         "net": proxy.get('network', 'tcp'),
-        "type": proxy.get('ws-opts', {}).get('headers', {}).get('Host', 'none') if proxy.get('network') == 'ws' else 'none',
-        "host": proxy.get('ws-opts', {}).get('path', '') if proxy.get('network') == 'ws' else '',
-        "path": proxy.get('ws-opts', {}).get('path', '') if proxy.get('network') == 'ws' else '',
+        "type": ws_opts.get('headers', {}).get('Host', 'none') if is_ws else 'none',
+        "host": ws_path,
+        "path": ws_path,
         "tls": "tls" if proxy.get('tls', False) else "",
         "sni": proxy.get('servername', ''),
         "alpn": proxy.get('alpn', [])
     }
     
-    vmess_json = json.dumps(vmess_config, separators=(',', ':'))
-    vmess_base64 = base64.b64encode(vmess_json.encode('utf-8')).decode('utf-8')
+    # ensure_ascii 输出纯 ASCII，base64 结果也是 ASCII
+    vmess_base64 = base64.b64encode(_vmess_json(vmess_config).encode('ascii')).decode('ascii')
     return f"vmess://{vmess_base64}"
 
 def convert_vless(proxy):
@@ -600,17 +1088,13 @@ def convert_vless(proxy):
     server = proxy.get('server', '')
     port = proxy.get('port', '')
     uuid = proxy.get('uuid', '')
-    name = urllib.parse.quote(proxy.get('name', ''))
+    name = quote_name(proxy.get('name', ''))
     
-    params = []
-    if proxy.get('network'):
-        params.append(f"type={proxy['network']}")
-    if proxy.get('tls'):
-        params.append("security=tls")
-    if proxy.get('sni'):
-        params.append(f"sni={proxy['sni']}")
-    
-    query = '&'.join(params) if params else ''
+    query = '&'.join(filter(None, (
+        f"type={proxy['network']}" if proxy.get('network') else '',
+        "security=tls" if proxy.get('tls') else '',
+        f"sni={proxy['sni']}" if proxy.get('sni') else '',
+    )))
     return f"vless://{uuid}@{server}:{port}?{query}#{name}"
 
 def convert_trojan(proxy):
@@ -618,15 +1102,12 @@ def convert_trojan(proxy):
     server = proxy.get('server', '')
     port = proxy.get('port', '')
     password = proxy.get('password', '')
-    name = urllib.parse.quote(proxy.get('name', ''))
-    
-    params = []
-    if proxy.get('sni'):
-        params.append(f"sni={proxy['sni']}")
-    if proxy.get('skip-cert-verify'):
-        params.append("allowInsecure=1")
+    name = quote_name(proxy.get('name', ''))
     
-    query = '&'.join(params) if params else ''
+    query = '&'.join(filter(None, (
+        f"sni={proxy['sni']}" if proxy.get('sni') else '',
+        "allowInsecure=1" if proxy.get('skip-cert-verify') else '',
+    )))
     return f"trojan://{password}@{server}:{port}?{query}#{name}"
 
 def convert_shadowsocks(proxy):
@@ -635,11 +1116,11 @@ def convert_shadowsocks(proxy):
     port = proxy.get('port', '')
     method = proxy.get('cipher', '')
     password = proxy.get('password', '')
-    name = urllib.parse.quote(proxy.get('name', ''))
+    name = quote_name(proxy.get('name', ''))
     
     # method:password
     userinfo = f"{method}:{password}"
-    userinfo_base64 = base64.b64encode(userinfo.encode('utf-8')).decode('utf-8')
+    userinfo_base64 = base64.b64encode(userinfo.encode('utf-8')).decode('ascii')
     
     return f"ss://{userinfo_base64}@{server}:{port}#{name}"
 
@@ -651,10 +1132,11 @@ def convert_shadowsocksr(proxy):
     protocol = proxy.get('protocol', '')
     method = proxy.get('cipher', '')
     obfs = proxy.get('obfs', '')
-    password = base64.b64encode(proxy.get('password', '').encode('utf-8')).decode('utf-8')
+    password = base64.b64encode(proxy.get('password', '').encode('utf-8'))
     
-    ssr_raw = f"{server}:{port}:{protocol}:{method}:{obfs}:{password}"
-    ssr_base64 = base64.b64encode(ssr_raw.encode('utf-8')).decode('utf-8')
+    # 密码的 base64 直接以 bytes 拼接，整体只解码一次
+    ssr_raw = f"{server}:{port}:{protocol}:{method}:{obfs}:".encode('utf-8') + password
+    ssr_base64 = base64.b64encode(ssr_raw).decode('ascii')
     
     return f"ssr://{ssr_base64}"
 
@@ -663,20 +1145,24 @@ def convert_hysteria2(proxy):
     server = proxy.get('server', '')
     port = proxy.get('port', '')
     password = proxy.get('password', '')
-    name = urllib.parse.quote(proxy.get('name', ''))
-    
-    params = []
-    if proxy.get('sni'):
-        params.append(f"sni={proxy['sni']}")
-    if proxy.get('skip-cert-verify'):
-        params.append("insecure=1")
+    name = quote_name(proxy.get('name', ''))
     
-    query = '&'.join(params) if params else ''
+    query = '&'.join(filter(None, (
+        f"sni={proxy['sni']}" if proxy.get('sni') else '',
+        "insecure=1" if proxy.get('skip-cert-verify') else '',
+    )))
     return f"hysteria2://{password}@{server}:{port}?{query}#{name}"
 
 if __name__ == "__main__":
+    # uvloop 可选 (不支持 Windows)，减少大量小请求时的事件循环开销；uvloop.run 需要 0.18+
+    try:
+        import uvloop
+        run = uvloop.run
+    except (ImportError, AttributeError):
+        run = asyncio.run
+
     try:
-        asyncio.run(process_proxies())
+        run(process_proxies())
     except Exception as e:
         print(f"\n❌ Fatal error: {e}", flush=True)
         import traceback
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import aiohttp
+import yaml
+from utils.yaml_utils import SafeDumper
+
+class ClashPool:
+    """
+    Spawns extra Clash (mihomo) processes from the same proxy list so that
+    several nodes can be switched and probed at the same time.
+    Each instance gets its own mixed-port and external-controller port.
+    """
+    def __init__(self, binary, proxies, count, base_port=19100):
+        self.binary = binary
+        self.proxies = proxies
+        self.count = count
+        self.base_port = base_port
+        self.work_dir = None
+        self.processes = []
+        self.instances = []  # list of (api_url, mixed_port)
+
+    def _build_config(self, mixed_port, api_port):
+        return {
+            "mixed-port": mixed_port,
+            "allow-lan": False,
+            "bind-address": "127.0.0.1",
+            "mode": "global",
+            "log-level": "warning",
+            "external-controller": f"127.0.0.1:{api_port}",
+            "secret": "",
+            "proxies": self.proxies,
+        }
+
+    async def _wait_ready(self, api_url, timeout=10):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=1)) as session:
+            while loop.time() < deadline:
+                try:
+                    async with session.get(f"{api_url}/version") as resp:
+                        if resp.status == 200:
+                            return True
+                except Exception:
+                    pass
+                await asyncio.sleep(0.2)
+        return False
+
+    async def start(self):
+        """Starts the instances and returns the ones that came up as (api_url, mixed_port)."""
+        if not self.binary or not os.path.exists(self.binary):
+            print(f"Clash binary not found: {self.binary}")
+            return []
+
+        self.work_dir = tempfile.mkdtemp(prefix="clash_pool_")
+        for k in range(self.count):
+            mixed_port = self.base_port + k * 2
+            api_port = mixed_port + 1
+            config_path = os.path.join(self.work_dir, f"instance_{k}.yaml")
+            with open(config_path, 'w', encoding='utf-8') as f:
+                yaml.dump(self._build_config(mixed_port, api_port), f, Dumper=SafeDumper, allow_unicode=True, sort_keys=False)
+
+            log = open(os.path.join(self.work_dir, f"instance_{k}.log"), 'wb')
+            proc = await asyncio.create_subprocess_exec(
+                self.binary, "-d", self.work_dir, "-f", config_path,
+                stdout=log, stderr=asyncio.subprocess.STDOUT
+            )
+            log.close()
+            self.processes.append(proc)
+
+            api_url = f"http://127.0.0.1:{api_port}"
+            if await self._wait_ready(api_url):
+                self.instances.append((api_url, mixed_port))
+            else:
+                print(f"Clash instance {k} failed to start (api {api_url})")
+
+        return self.instances
+
+    async def stop(self):
+        for proc in self.processes:
+            if proc.returncode is None:
+                proc.terminate()
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    proc.kill()
+        self.processes = []
+        self.instances = []
+        if self.work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
@@ -1,5 +1,6 @@
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # 立即输出诊断信息
 print("🚀 download_sub.py starting...", flush=True)
@@ -15,7 +16,8 @@ except ImportError as e:
 
 try:
     import yaml
-    print("✅ PyYAML imported", flush=True)
+    from utils.yaml_utils import SafeLoader, SafeDumper
+    print(f"✅ PyYAML imported (loader: {SafeLoader.__name__})", flush=True)
 except ImportError as e:
     print(f"❌ Failed to import PyYAML: {e}", flush=True)
     sys.exit(1)
@@ -43,14 +45,84 @@ headers = {
     "User-Agent": "Clash/1.0"
 }
 
-for index, url in enumerate(urls):
+# 2. 并行下载所有订阅 (共享 Session 复用连接)，之后按原顺序逐个解析，保证输出顺序与日志稳定
+session = requests.Session()
+session.headers.update(headers)
+
+def fetch(url):
+    # 任何异常都只记在该链接上，由下面的逐个处理阶段打印，不影响其他订阅
+    try:
+        return session.get(url, timeout=30), None
+    except Exception as e:
+        return None, e
+
+def load_proxies_only(content):
+    """
+    只构造顶层 proxies 列表: 先用事件流定位 proxies 序列在原文中的位置，
+    再单独解析这一段，proxy-groups / rules 等无用的段不会被构造成对象 (仍扫描到结尾以处理重复的键)。
+    遇到任何无法切分的情况 (非 UTF-8、proxies 引用外部锚点等) 回退到完整解析。
+    """
+    try:
+        text = content.decode('utf-8-sig')
+        depth = 0
+        expect_key = False
+        capture = False
+        start_mark = None
+        found = None
+        for event in yaml.parse(text, Loader=SafeLoader):
+            if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+                if depth == 0:
+                    if not isinstance(event, yaml.MappingStartEvent):
+                        break
+                    expect_key = True
+                elif depth == 1:
+                    if expect_key:
+                        break  # 复杂键，交给完整解析
+                    if capture:
+                        if not isinstance(event, yaml.SequenceStartEvent):
+                            break  # proxies 不是列表
+                        start_mark = event.start_mark
+                depth += 1
+            elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                depth -= 1
+                if depth == 0:
+                    # 顶层映射结束: 重复的 proxies 键以最后一个为准，与完整解析一致
+                    if found is not None:
+                        return {'proxies': found}
+                    break  # 没有 proxies
+                if depth == 1:
+                    if start_mark is not None:
+                        # 补齐首行缩进，使这一段单独解析时与原文结构一致
+                        block = " " * start_mark.column + text[start_mark.index:event.end_mark.index]
+                        found = yaml.load(block, Loader=SafeLoader)
+                        if not isinstance(found, list):
+                            break
+                        start_mark = None
+                    expect_key = True
+            elif depth == 1 and isinstance(event, (yaml.ScalarEvent, yaml.AliasEvent)):
+                if expect_key:
+                    capture = isinstance(event, yaml.ScalarEvent) and event.value == 'proxies'
+                elif capture:
+                    break  # proxies 不是列表
+                expect_key = not expect_key
+    except (UnicodeDecodeError, yaml.YAMLError):
+        pass
+    return yaml.load(content, Loader=SafeLoader)
+
+print(f"📡 Downloading {len(urls)} subscriptions in parallel...", flush=True)
+with ThreadPoolExecutor(max_workers=min(8, len(urls))) as executor:
+    responses = list(executor.map(fetch, urls))
+session.close()
+
+for index, (url, (resp, fetch_error)) in enumerate(zip(urls, responses)):
     # 生成订阅源标识（Sub-1, Sub-2, ...）
     source_id = f"Sub-{index+1}"
     # 安全地显示URL（只显示前30个字符）
     safe_url = url[:30] + "..." if len(url) > 30 else url
     print(f"[{index+1}/{len(urls)}] Downloading: {safe_url} ({source_id})", flush=True)
     try:
-        resp = requests.get(url, headers=headers, timeout=30)
+        if fetch_error is not None:
+            raise fetch_error
         print(f"   Response status: {resp.status_code}", flush=True)
         resp.raise_for_status()
         
@@ -61,7 +133,7 @@ for index, url in enumerate(urls):
         
         # 解析 YAML
         try:
-            data = yaml.safe_load(resp.content)
+            data = load_proxies_only(resp.content)
             print(f"   YAML parsed, type: {type(data).__name__}", flush=True)
         except yaml.YAMLError as ye:
             print(f"   ⚠️ Warning: Failed to parse YAML: {ye}", flush=True)
@@ -105,9 +177,10 @@ final_config = {
 print("💾 Writing config.yaml...", flush=True)
 try:
     output_path = os.path.join(os.getcwd(), "config.yaml")
-    with open(output_path, "w", encoding='utf-8') as f:
+    # 1MB 写缓冲合并 dump 的小块写入；超大 width 省去 PyYAML 的折行计算
+    with open(output_path, "w", encoding='utf-8', buffering=1 << 20) as f:
         # allow_unicode=True 确保中文字符正常显示
-        yaml.dump(final_config, f, allow_unicode=True, default_flow_style=False)
+        yaml.dump(final_config, f, Dumper=SafeDumper, allow_unicode=True, default_flow_style=False, width=10**9)
     
     # 验证文件已写入
     if os.path.exists(output_path):
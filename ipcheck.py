@@ -1,16 +1,130 @@
 import asyncio
+import bisect
+import functools
+import os
 import re
+import time
+import types
 import aiohttp
 from playwright.async_api import async_playwright
 
+# Images, media, fonts and trackers are aborted by URL pattern, so only the
+# matching requests are routed through Python; everything else loads untouched
+_BLOCKED_URL_RE = re.compile(
+    r"\.(?:png|jpe?g|gif|webp|svg|ico|woff2?|ttf|otf|mp4|webm|mp3)(?:\?|$)"
+    r"|google-analytics|googletagmanager|doubleclick|hm\.baidu\.com",
+    re.IGNORECASE
+)
+
+# Pulls the five result fields out of the rendered text inside the page, so only
+# a small dict crosses the wire instead of the whole body text
+_EXTRACT_JS = """() => {
+    const t = document.body.innerText;
+    const m = (re) => (t.match(re) || [])[1] || "";
+    return {
+        pure: m(/IPPure系数[\\s\\S]*?(\\d+%)/),
+        bot: m(/bot\\s*(\\d+(?:\\.\\d+)?)%/i),
+        attr: m(/IP属性[ \\t]*\\n?\\s*([^\\n]+)/),
+        src: m(/IP来源[ \\t]*\\n?\\s*([^\\n]+)/),
+        ip: m(/\\b((?:\\d{1,3}\\.){3}\\d{1,3})\\b/)
+    };
+}"""
+
+# True once the score and the attribute/source fields have rendered
+_RESULTS_READY_JS = """() => {
+    const t = document.body.innerText;
+    return /IPPure系数[\\s\\S]*?\\d+%/.test(t) && /IP属性\\s*\\S/.test(t) && /IP来源\\s*\\S/.test(t);
+}"""
+
+# Seconds the host's own (proxy-less) IP is reused before probing again
+_LOCAL_IP_TTL = 600
+
+_PLAIN_HEADERS = {"Accept": "text/plain"}
+
+# Validates a fast IP probe answer
+_IPV4_RE = re.compile(r"^\d{1,3}(?:\.\d{1,3}){3}$")
+
+_UNKNOWN = "❓"
+
+# 备用方案评估的IP段 (首字节)，这些段在日志中出现过
+_HEURISTIC_8S = frozenset({103, 134, 46, 13})
+
+# 属性缩写映射
+_ATTR_ABBR = {
+    "机房": "机",
+    "数据中心": "机",
+    "住宅": "宅",
+    "企业": "企",
+    "教育": "教"
+}
+
+# 来源缩写映射
+_SRC_ABBR = {
+    "原生": "原",
+    "广播": "广",
+    "ISP": "ISP",
+    "企业": "企"
+}
+
+def _render_full_string(result):
+    """构建精简的输出字符串（方案C：Emoji+文字缩写）"""
+    attr = result["ip_attr"]
+    src = result["ip_src"]
+    # 应用缩写，未知字段不参与显示
+    attr_short = "" if attr == _UNKNOWN else _ATTR_ABBR.get(attr, attr[:1])
+    src_short = "" if src == _UNKNOWN else _SRC_ABBR.get(src, src[:1])
+
+    if attr_short and src_short:
+        info = f"{attr_short}|{src_short}"
+    else:
+        info = attr_short or src_short or "检测中"
+
+    return f"【{result['pure_emoji']}{result['bot_emoji']} {info}】"
+
+# Upper bound (inclusive) of each emoji band, user approved thresholds
+_EMOJI_THRESH = (10, 30, 50, 70, 90)
+_EMOJI = ("⚪", "🟢", "🟡", "🟠", "🔴", "⚫")
+
+@functools.lru_cache(maxsize=128)
+def _emoji_for(percentage_str):
+    # Scores repeat a lot across a run, so each distinct string is parsed once
+    try:
+        val = float(percentage_str.rstrip('%'))
+    except (AttributeError, ValueError):
+        return "❓"
+    return _EMOJI[bisect.bisect_left(_EMOJI_THRESH, val)]
+
+def _default_max_pages():
+    """IPCHECK_MAX_PAGES if it is a positive integer, else the CPU count; never below 2."""
+    try:
+        limit = int(os.environ.get("IPCHECK_MAX_PAGES", ""))
+    except ValueError:
+        limit = 0
+    # At least 2, so callers racing two attempts per proxy (clash_automator's
+    # check_first_success) are not serialized by the limit
+    return max(limit if limit > 0 else (os.cpu_count() or 4), 2)
+
 class IPChecker:
-    def __init__(self, headless=True):
+    def __init__(self, headless=True, proxy_cache_ttl=0, max_pages=None):
+        """Browser-based IP purity checker with IP and optional per-proxy result caches."""
         self.headless = headless
+        self.proxy_cache_ttl = proxy_cache_ttl # Seconds per proxy URL; 0 = off, only safe when a URL always maps to one node
+        self.max_pages = max_pages or _default_max_pages() # Pages open at once
+        self._page_sem = None # Created in start(), bounds concurrent pages to max_pages
+        self._proxy_cache = {} # Map proxy URL -> (monotonic timestamp, Result Dict)
         self.browser = None
         self.playwright = None
         self.cache = {} # Map IP -> Result Dict
+        self.session = None # Shared by all get_simple_ip calls
+        self._contexts = {} # Map proxy -> pooled context entry (exit IP, context, users), reused across checks
+        self._context_lock = None
+        self._pending_teardowns = set() # Page/context closes still running
+        self._local_ip = None # (monotonic timestamp, host IP) for proxy-less checks
+        self._local_ip_lock = None
 
     async def start(self):
+        self._context_lock = asyncio.Lock()
+        self._page_sem = asyncio.Semaphore(self.max_pages)
         self.playwright = await async_playwright().start()
         self.browser = await self.playwright.chromium.launch(
             headless=self.headless,
@@ -18,47 +132,148 @@ class IPChecker:
         )
 
     async def stop(self):
+        if self._pending_teardowns:
+            await asyncio.gather(*self._pending_teardowns, return_exceptions=True)
+        for entry in self._contexts.values():
+            try:
+                await entry["context"].close()
+            except Exception:
+                pass
+        self._contexts = {}
+        if self.session:
+            await self.session.close()
+            self.session = None
         if self.browser:
             await self.browser.close()
         if self.playwright:
             await self.playwright.stop()
 
+    def _get_session(self):
+        # Lazy, so fast IP checks work without the browser; force_close since Clash pins connections to a node
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=3),
+                connector=aiohttp.TCPConnector(limit=64, force_close=True)
+            )
+        return self.session
+
+    async def _new_context(self, proxy):
+        context_args = {
+             "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+        }
+        if proxy:
+            context_args["proxy"] = {"server": proxy}
+
+        context = await self.browser.new_context(**context_args)
+
+        # Resource blocking (Optimization)
+        await context.route(_BLOCKED_URL_RE, lambda route: route.abort())
+        return context
+
+    async def _acquire_context(self, proxy, ip):
+        """Returns (context, entry) for this exit IP; pass both to _release_context when done."""
+        if not ip:
+            return await self._new_context(proxy), None
+        async with self._context_lock:
+            entry = self._contexts.get(proxy)
+            if entry is None or entry["ip"] != ip:
+                old = entry
+                entry = {"proxy": proxy, "ip": ip, "context": await self._new_context(proxy), "users": 0}
+                self._contexts[proxy] = entry
+                # A replaced context still in use is closed by its last user
+                if old is not None and old["users"] == 0:
+                    await old["context"].close()
+            elif entry["users"] == 0:
+                # Only wiped while idle, never under a concurrent check
+                await entry["context"].clear_cookies()
+            entry["users"] += 1
+            return entry["context"], entry
+
+    async def _release_context(self, context, entry):
+        if entry is None:
+            await context.close()
+            return
+        entry["users"] -= 1
+        if entry["users"] == 0 and self._contexts.get(entry["proxy"]) is not entry:
+            await context.close()
+
+    async def _teardown(self, page, context, entry):
+        try:
+            await page.close()
+        except Exception:
+            pass
+        try:
+            await self._release_context(context, entry)
+        except Exception:
+            pass
+
     def get_emoji(self, percentage_str):
+        return _emoji_for(percentage_str)
+
+    async def _fetch_ip(self, url, proxy=None):
+        """Returns the IPv4 reported by one probe URL, or None."""
         try:
-            val = float(percentage_str.replace('%', ''))
-            # Logic from ipcheck.py with user approved thresholds
-            if val <= 10: return "⚪"
-            if val <= 30: return "🟢"
-            if val <= 50: return "🟡"
-            if val <= 70: return "🟠"
-            if val <= 90: return "🔴"
-            return "⚫"
-        except:
-            return "❓"
+            async with self._get_session().get(url, proxy=proxy, headers=_PLAIN_HEADERS) as resp:  # User modified timeout to 3s
+                if resp.status == 200:
+                    # An IPv4 fits in 15 bytes; a body over 64 bytes is an error page.
+                    # read(n) may return less than n, so read until EOF or past the cap.
+                    body = b""
+                    while len(body) <= 64:
+                        chunk = await resp.content.read(65 - len(body))
+                        if not chunk:
+                            break
+                        body += chunk
+                    ip = body.decode('ascii', 'ignore').strip()
+                    if len(body) <= 64 and _IPV4_RE.match(ip):
+                        return ip
+        except Exception:
+            pass
+        return None
 
     async def get_simple_ip(self, proxy=None):
-        """Fast IPv4 check for caching."""
+        """Fast IPv4 check for caching. Both probe URLs are raced, first valid answer wins."""
         urls = ["http://api.ipify.org", "http://v4.ident.me"]
-        for url in urls:
-            try:
-                # User modified timeout to 3s
-                timeout = aiohttp.ClientTimeout(total=3)
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    async with session.get(url, proxy=proxy) as resp:
-                        if resp.status == 200:
-                            ip = (await resp.text()).strip()
-                            if re.match(r"^\d{1,3}(\.\d{1,3}){3}\d{1,3}$", ip):
-                                return ip
-            except Exception:
-                continue 
+        tasks = [asyncio.create_task(self._fetch_ip(url, proxy)) for url in urls]
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result():
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
         return None
 
+    async def _get_ip(self, proxy):
+        """get_simple_ip, with the host's own IP (no proxy) memoized for _LOCAL_IP_TTL."""
+        if proxy is not None:
+            return await self.get_simple_ip(proxy)
+        if self._local_ip_lock is None:
+            self._local_ip_lock = asyncio.Lock()
+        async with self._local_ip_lock:
+            if self._local_ip and time.monotonic() - self._local_ip[0] < _LOCAL_IP_TTL:
+                return self._local_ip[1]
+            ip = await self.get_simple_ip()
+            if ip:
+                self._local_ip = (time.monotonic(), ip)
+            return ip
+
     async def check(self, url="https://ippure.com/", proxy=None, timeout=20000, retry=2):
+        """Returns the purity result for the exit IP of `proxy` as a read-only mapping."""
+        # 0. Per-proxy cache (opt-in), answered without any network round-trip
+        if proxy and self.proxy_cache_ttl:
+            cached = self._proxy_cache.get(proxy)
+            if cached and time.monotonic() - cached[0] < self.proxy_cache_ttl:
+                print(f"     [Proxy Cache Hit] {proxy}")
+                return cached[1]
+
         if not self.browser:
             await self.start()
         
         # 1. Cleaner Fast IP & Cache Logic
-        current_ip = await self.get_simple_ip(proxy)
+        current_ip = await self._get_ip(proxy)
         if current_ip and current_ip in self.cache:
             print(f"     [Cache Hit] {current_ip}")
             return self.cache[current_ip]
@@ -69,121 +284,80 @@ class IPChecker:
             print("     [Warning] Fast IP check failed. Scanning with browser...")
 
         # 2. Browser Check (Logic from ipcheck.py)
-        context_args = {
-             "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        }
-        if proxy:
-            context_args["proxy"] = {"server": proxy}
-            
-        context = await self.browser.new_context(**context_args)
-        
-        # Resource blocking (Optimization)
-        await context.route("**/*", lambda route: route.abort() 
-            if route.request.resource_type in ["image", "media", "font"] 
-            else route.continue_())
-
-        page = await context.new_page()
+        async with self._page_sem:
+            context, entry = await self._acquire_context(proxy, current_ip)
+            try:
+                page = await context.new_page()
+            except Exception:
+                await self._release_context(context, entry)
+                raise
         
-        # Default Result Structure
-        result = {
-            "pure_emoji": "❓", "bot_emoji": "❓", "ip_attr": "❓", "ip_src": "❓",
-            "pure_score": "❓", "bot_score": "❓", "full_string": "", "ip": current_ip if current_ip else "❓", "error": None
-        }
+            # Default Result Structure
+            result = {
+                "pure_emoji": "❓", "bot_emoji": "❓", "ip_attr": "❓", "ip_src": "❓",
+                "pure_score": "❓", "bot_score": "❓", "full_string": "", "ip": current_ip if current_ip else "❓", "error": None
+            }
+            # Read-only view shared by the caches and the caller, so results are never copied
+            view = types.MappingProxyType(result)
 
-        try:
-            await page.goto(url, wait_until="domcontentloaded", timeout=timeout)
-            
-            # Logic from ipcheck.py - Optimized wait
             try:
-                await page.wait_for_selector("text=人机流量比", timeout=10000)
-            except:
-                pass 
-
-            await page.wait_for_timeout(2000)
-            text = await page.inner_text("body")
-
-            # 1. IPPure Score
-            score_match = re.search(r"IPPure系数.*?(\d+%)", text, re.DOTALL)
-            if score_match:
-                result["pure_score"] = score_match.group(1)
-                result["pure_emoji"] = self.get_emoji(result["pure_score"])
-
-            # 2. Bot Ratio
-            bot_match = re.search(r"bot\s*(\d+(\.\d+)?)%", text, re.IGNORECASE)
-            if bot_match:
-                val = bot_match.group(0).replace('bot', '').strip()
-                if not val.endswith('%'): val += "%"
-                result["bot_score"] = val
-                result["bot_emoji"] = self.get_emoji(val)
-
-            # 3. Attributes
-            attr_match = re.search(r"IP属性\s*\n\s*(.+)", text)
-            if not attr_match: attr_match = re.search(r"IP属性\s*(.+)", text)
-            if attr_match:
-                raw = attr_match.group(1).strip()
-                result["ip_attr"] = re.sub(r"IP$", "", raw)
-
-            # 4. Source
-            src_match = re.search(r"IP来源\s*\n\s*(.+)", text)
-            if not src_match: src_match = re.search(r"IP来源\s*(.+)", text)
-            if src_match:
-                raw = src_match.group(1).strip()
-                result["ip_src"] = re.sub(r"IP$", "", raw)
-
-            # 5. Fallback IP if fast check failed
-            if result["ip"] == "❓":
-                ip_match = re.search(r"\b(?:\d{1,3}\.){3}\d{1,3}\b", text)
-                if ip_match: result["ip"] = ip_match.group(0)
-
-            # 构建精简的输出字符串（方案C：Emoji+文字缩写）
-            attr = result["ip_attr"] if result["ip_attr"] != "❓" else ""
-            src = result["ip_src"] if result["ip_src"] != "❓" else ""
-            
-            # 属性缩写映射
-            attr_abbr_map = {
-                "机房": "机",
-                "数据中心": "机",
-                "住宅": "宅",
-                "企业": "企",
-                "教育": "教"
-            }
-            
-            # 来源缩写映射
-            src_abbr_map = {
-                "原生": "原",
-                "广播": "广",
-                "ISP": "ISP",
-                "企业": "企"
-            }
+                await page.goto(url, wait_until="domcontentloaded", timeout=timeout)
             
-            # 应用缩写
-            attr_short = attr_abbr_map.get(attr, attr[:1] if attr and attr != "❓" else "")
-            src_short = src_abbr_map.get(src, src[:1] if src and src != "❓" else "")
-
-            if attr_short and src_short:
-                info = f"{attr_short}|{src_short}"
-            elif attr_short:
-                info = attr_short
-            elif src_short:
-                info = src_short
-            else:
-                info = "检测中"
-            
-            result["full_string"] = f"【{result['pure_emoji']}{result['bot_emoji']} {info}】"
+                # Logic from ipcheck.py - Optimized wait
+                try:
+                    await page.wait_for_selector("text=人机流量比", timeout=10000)
+                except:
+                    pass 
 
-            # Cache Update
-            if result["ip"] != "❓" and result["pure_score"] != "❓":
-                self.cache[result["ip"]] = result.copy()
+                # Continue as soon as the fields are on the page instead of a fixed 2s sleep
+                try:
+                    await page.wait_for_function(_RESULTS_READY_JS, timeout=5000)
+                except Exception:
+                    await page.wait_for_timeout(500)
+                data = await page.evaluate(_EXTRACT_JS)
 
-        except Exception as e:
-            result["error"] = str(e)
-            result["full_string"] = "【❌ Error】"
-        finally:
-            if not self.headless:
-                print("     [Debug] Waiting 5s before closing browser window...")
-                await asyncio.sleep(5)
-            await page.close()
-            await context.close()
+                # 1. IPPure Score
+                if data["pure"]:
+                    result["pure_score"] = data["pure"]
+                    result["pure_emoji"] = self.get_emoji(result["pure_score"])
+
+                # 2. Bot Ratio
+                if data["bot"]:
+                    val = data["bot"] + "%"
+                    result["bot_score"] = val
+                    result["bot_emoji"] = self.get_emoji(val)
+
+                # 3. Attributes
+                if data["attr"]:
+                    result["ip_attr"] = data["attr"].strip().removesuffix("IP").rstrip()
+
+                # 4. Source
+                if data["src"]:
+                    result["ip_src"] = data["src"].strip().removesuffix("IP").rstrip()
+
+                # 5. Fallback IP if fast check failed
+                if result["ip"] == "❓" and data["ip"]:
+                    result["ip"] = data["ip"]
+
+                result["full_string"] = _render_full_string(result)
+
+                # Cache Update
+                if result["ip"] != "❓" and result["pure_score"] != "❓":
+                    self.cache[result["ip"]] = view
+
+            except Exception as e:
+                result["error"] = str(e)
+                result["full_string"] = "【❌ Error】"
+            finally:
+                if not self.headless:
+                    print("     [Debug] Waiting 5s before closing browser window...")
+                    await asyncio.sleep(5)
+                    await self._teardown(page, context, entry)
+                else:
+                    # Closed in the background so the result is returned right away
+                    task = asyncio.create_task(self._teardown(page, context, entry))
+                    self._pending_teardowns.add(task)
+                    task.add_done_callback(self._pending_teardowns.discard)
         
         # 如果主站检测失败且还有重试次数，尝试备用方案
         if result["pure_score"] == "❓" and retry > 0:
@@ -193,9 +367,15 @@ class IPChecker:
                 result.update(backup_result)
                 # 更新缓存
                 if result["ip"] != "❓" and result["pure_score"] != "❓":
-                    self.cache[result["ip"]] = result.copy()
+                    self.cache[result["ip"]] = view
+
+        if proxy and self.proxy_cache_ttl:
+            if result["error"] is None and result["pure_score"] != "❓":
+                self._proxy_cache[proxy] = (time.monotonic(), view)
+            else:
+                self._proxy_cache.pop(proxy, None)
             
-        return result
+        return view
     
     async def _backup_check(self, proxy=None, retry=0):
         """备用检测方案，使用更简单的检测逻辑"""
@@ -203,7 +383,7 @@ class IPChecker:
             # 尝试使用更简单的检测方法
             # 这里可以添加其他IP检测网站的逻辑
             # 暂时返回一个基于IP地址的简单评估
-            current_ip = await self.get_simple_ip(proxy)
+            current_ip = await self._get_ip(proxy)
             if not current_ip:
                 return None
                 
@@ -216,7 +396,7 @@ class IPChecker:
             }
             
             # 简单的IP段判断逻辑
-            if current_ip.startswith(("103.", "134.", "46.", "13.")):
+            if int(current_ip.split('.', 1)[0]) in _HEURISTIC_8S:
                 # 这些段在日志中出现过，给予一个基础评估
                 result["pure_emoji"] = "🟡"
                 result["bot_emoji"] = "🟠"
@@ -224,41 +404,7 @@ class IPChecker:
                 result["ip_src"] = "广播"
                 result["pure_score"] = "40%"
                 result["bot_score"] = "60%"
-                # 构建精简的输出字符串（方案C：Emoji+文字缩写）
-                attr = result["ip_attr"] if result["ip_attr"] != "❓" else ""
-                src = result["ip_src"] if result["ip_src"] != "❓" else ""
-                
-                # 属性缩写映射
-                attr_abbr_map = {
-                    "机房": "机",
-                    "数据中心": "机",
-                    "住宅": "宅",
-                    "企业": "企",
-                    "教育": "教"
-                }
-                
-                # 来源缩写映射
-                src_abbr_map = {
-                    "原生": "原",
-                    "广播": "广",
-                    "ISP": "ISP",
-                    "企业": "企"
-                }
-                
-                # 应用缩写
-                attr_short = attr_abbr_map.get(attr, attr[:1] if attr and attr != "❓" else "")
-                src_short = src_abbr_map.get(src, src[:1] if src and src != "❓" else "")
-
-                if attr_short and src_short:
-                    info = f"{attr_short}|{src_short}"
-                elif attr_short:
-                    info = attr_short
-                elif src_short:
-                    info = src_short
-                else:
-                    info = "检测中"
-                
-                result["full_string"] = f"【{result['pure_emoji']}{result['bot_emoji']} {info}】"
+                result["full_string"] = _render_full_string(result)
             
             return result
             
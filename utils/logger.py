@@ -0,0 +1,45 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+_listeners = []
+
+def _queue_logger(name, handler):
+    """
+    Logger whose records are handed to a background thread (QueueListener)
+    that does the actual write, so hot coroutines never block on I/O.
+    """
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    _listeners.append(listener)
+
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+def get_logger(name="clash_ip_checker"):
+    """Plain-message logger writing to stdout."""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    return _queue_logger(name, handler)
+
+def get_file_logger(name, path):
+    """Plain-message logger appending to a file."""
+    handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    return _queue_logger(name, handler)
+
+def flush_logger():
+    """Blocks until every queued record is written (call before mixing with print)."""
+    for listener in _listeners:
+        listener.stop()
+        listener.start()
@@ -0,0 +1,40 @@
+import functools
+import json
+import time
+from contextlib import asynccontextmanager
+from utils.logger import get_file_logger
+
+_logger = None
+
+def enable_profiling(path="profile.log"):
+    """Starts writing timing records as JSON lines to the given file."""
+    global _logger
+    _logger = get_file_logger("clash_ip_checker.profile", path)
+
+def record(name, dt, **fields):
+    if _logger:
+        _logger.info(json.dumps({"name": name, "dt": round(dt, 6), **fields}, ensure_ascii=False))
+
+@asynccontextmanager
+async def stage(name, **fields):
+    """Times the enclosed block, e.g. `async with stage("phase1", n=len(proxies)):`."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0, **fields)
+
+def timed(name):
+    """Decorator recording the duration of every call to an async function."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not _logger:
+                return await func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - t0)
+        return wrapper
+    return decorator
@@ -0,0 +1,12 @@
+import yaml
+
+# Prefer the libyaml-backed C loader, fall back to the pure-Python one
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# libyaml's emitter escapes non-BMP characters (the emoji written into node
+# names) as \UXXXXXXXX even with allow_unicode, so dumping stays on the
+# pure-Python SafeDumper to keep the output readable.
+from yaml import SafeDumper